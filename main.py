@@ -1,14 +1,20 @@
 import os
-import io
-import uuid
-from collections import defaultdict
-from datetime import datetime, timedelta
-from io import BytesIO
+import heapq
+import json
+import re
+import secrets
+import time
+import zipfile
+from collections import OrderedDict, defaultdict
+from datetime import datetime
+from xml.etree.ElementTree import ParseError
 
 import openpyxl
+from openpyxl.utils import get_column_letter
 from fastapi import FastAPI, UploadFile, File, HTTPException
-from fastapi.responses import StreamingResponse, JSONResponse
+from fastapi.responses import Response, JSONResponse
 from fastapi.middleware.cors import CORSMiddleware
+from starlette.concurrency import run_in_threadpool
 
 
 app = FastAPI(title="Validador de Matrices")
@@ -38,25 +44,37 @@ app.add_middleware(
 # ==========================
 # Descargas temporales
 # ==========================
-DOWNLOADS = {}
+DOWNLOADS = OrderedDict()
+MAX_DOWNLOADS = 1024  # tope de reportes en memoria; se descarta el menos usado
 EXP_MINUTES = 5
-
-def cleanup_downloads():
-    now = datetime.utcnow()
-    expired = [t for t, v in DOWNLOADS.items() if v["exp"] <= now]
-    for t in expired:
+EXP_NS = EXP_MINUTES * 60 * 1_000_000_000
+_EXP_HEAP = []  # (exp_ns, token), el más próximo a expirar en la cima
+
+def cleanup_downloads(now_ns=None):
+    if now_ns is None:
+        now_ns = time.monotonic_ns()
+    while _EXP_HEAP and _EXP_HEAP[0][0] <= now_ns:
+        _, t = heapq.heappop(_EXP_HEAP)
         DOWNLOADS.pop(t, None)
 
 def register_download(data: bytes, filename: str, media_type: str) -> str:
-    cleanup_downloads()
-    token = str(uuid.uuid4())
-    expires_at = datetime.utcnow() + timedelta(minutes=EXP_MINUTES)
+    now_ns = time.monotonic_ns()
+    cleanup_downloads(now_ns)
+    token = secrets.token_urlsafe(16)
+    expires_at = now_ns + EXP_NS
     DOWNLOADS[token] = {
         "data": data,
         "filename": filename,
         "media_type": media_type,
-        "exp": expires_at
     }
+    heapq.heappush(_EXP_HEAP, (expires_at, token))
+    while len(DOWNLOADS) > MAX_DOWNLOADS:
+        DOWNLOADS.popitem(last=False)
+    # Las entradas de tokens desalojados siguen en el heap hasta expirar; se purgan
+    # para que el heap también quede acotado
+    if len(_EXP_HEAP) > 2 * MAX_DOWNLOADS:
+        _EXP_HEAP[:] = [e for e in _EXP_HEAP if e[1] in DOWNLOADS]
+        heapq.heapify(_EXP_HEAP)
     return token
 
 # ==========================
@@ -64,42 +82,82 @@ def register_download(data: bytes, filename: str, media_type: str) -> str:
 # ==========================
 CARACTERES_PROHIBIDOS = set("!@#$%&/()=\u00a1\u00a8*[];:_°|\u00ac")
 ENCABEZADOS_ESPERADOS = ["Capitulo", "Subcapitulo", "Preguntas"]
+_ENCABEZADOS_TUPLA = tuple(ENCABEZADOS_ESPERADOS)
 
-def validar_encabezados(sheet):
+# Patrón precompilado: la búsqueda corre en el motor de re (C)
+_PROHIB_RE = re.compile('[' + re.escape(''.join(sorted(CARACTERES_PROHIBIDOS))) + ']')
+
+def _errores_encabezados(fila):
+    fila = tuple(fila[:3])
+    if fila == _ENCABEZADOS_TUPLA:
+        return []
     errores = []
-    for col, esperado in zip(['A', 'B', 'C'], ENCABEZADOS_ESPERADOS):
-        celda = f"{col}1"
-        valor = str(sheet[celda].value).strip() if sheet[celda].value else ""
+    fila += (None,) * (3 - len(fila))
+    for col, esperado, valor in zip(['A', 'B', 'C'], ENCABEZADOS_ESPERADOS, fila):
+        valor = str(valor).strip() if valor else ""
         if valor != esperado:
             errores.append(
-                f"❌ Celda {celda} debería contener '{esperado}', pero tiene '{valor}'"
+                f"❌ Celda {col}1 debería contener '{esperado}', pero tiene '{valor}'"
             )
     return errores
 
-def buscar_preguntas_duplicadas(sheet):
+# Una sola pasada sobre la hoja: encabezados, duplicados y caracteres prohibidos
+def validar_sheet(sheet):
+    errores_encabezados = None
+    errores_caracteres = []
     preguntas = defaultdict(list)
-    for row in range(2, sheet.max_row + 1):
-        valor = sheet[f"C{row}"].value
-        if valor:
-            valor = str(valor).strip()
-            preguntas[valor].append(row)
-    return [
+
+    for row_idx, row in enumerate(sheet.iter_rows(values_only=True), start=1):
+        # Las filas vacías no aportan nada que validar
+        if all(v is None for v in row):
+            continue
+        if row_idx == 1:
+            errores_encabezados = _errores_encabezados(row)
+        else:
+            valor = row[2] if len(row) > 2 else None
+            if valor:
+                preguntas[str(valor).strip()].append(row_idx)
+
+        for col_idx, valor in enumerate(row, start=1):
+            if valor and isinstance(valor, str):
+                m = _PROHIB_RE.search(valor)
+                if m:
+                    errores_caracteres.append(
+                        f"❌ Celda {get_column_letter(col_idx)}{row_idx} contiene caracter prohibido '{m.group()}' en: '{valor}'"
+                    )
+
+    if errores_encabezados is None:
+        errores_encabezados = _errores_encabezados(())
+    errores_duplicados = [
         f"❌ Pregunta duplicada en filas {v}: '{k}'"
         for k, v in preguntas.items() if len(v) > 1
     ]
+    return errores_encabezados + errores_duplicados + errores_caracteres
 
-def buscar_caracteres_prohibidos(sheet):
-    errores = []
-    for row in sheet.iter_rows(min_row=1, max_row=sheet.max_row):
-        for cell in row:
-            if cell.value and isinstance(cell.value, str):
-                for c in cell.value:
-                    if c in CARACTERES_PROHIBIDOS:
-                        errores.append(
-                            f"❌ Celda {cell.coordinate} contiene caracter prohibido '{c}' en: '{cell.value}'"
-                        )
-                        break
-    return errores
+def _procesar_sync(archivo) -> bytes:
+    try:
+        wb = openpyxl.load_workbook(archivo, read_only=True, keep_links=False)
+    except Exception as e:
+        raise HTTPException(status_code=400, detail=f"No se pudo abrir el archivo: {e}")
+
+    # La hoja se parsea de forma perezosa: los errores de XML aparecen al recorrerla
+    try:
+        hoja = wb.active
+        # En modo read-only la hoja confía en <dimension>; se recalcula al leer
+        hoja.reset_dimensions()
+        errores = validar_sheet(hoja)
+    except (zipfile.BadZipFile, ParseError, KeyError, ValueError) as e:
+        raise HTTPException(status_code=400, detail=f"No se pudo abrir el archivo: {e}")
+    finally:
+        wb.close()
+
+    # Crear reporte TXT
+    if not errores:
+        lines = ["✅ VALIDACIÓN EXITOSA: No se encontraron errores.\n"]
+    else:
+        lines = ["❌ VALIDACIÓN FALLIDA: Se encontraron errores:\n\n"]
+        lines.extend(f"{err}\n" for err in errores)
+    return "".join(lines).encode("utf-8")
 
 # ==========================
 # Endpoints
@@ -109,54 +167,45 @@ async def procesar(file: UploadFile = File(...)):
     if not file.filename.endswith(".xlsx"):
         raise HTTPException(status_code=400, detail="El archivo debe ser .xlsx")
 
-    try:
-        wb = openpyxl.load_workbook(file.file)
-        hoja = wb.active
-    except Exception as e:
-        raise HTTPException(status_code=400, detail=f"No se pudo abrir el archivo: {e}")
-
-    errores = []
-    errores.extend(validar_encabezados(hoja))
-    errores.extend(buscar_preguntas_duplicadas(hoja))
-    errores.extend(buscar_caracteres_prohibidos(hoja))
-
-    # Crear reporte TXT
-    txt_bytes = BytesIO()
-    if not errores:
-        txt_bytes.write("✅ VALIDACIÓN EXITOSA: No se encontraron errores.\n".encode("utf-8"))
-    else:
-        txt_bytes.write("❌ VALIDACIÓN FALLIDA: Se encontraron errores:\n\n".encode("utf-8"))
-        for err in errores:
-            txt_bytes.write(f"{err}\n".encode("utf-8"))
-    txt_bytes.seek(0)
+    # openpyxl es síncrono: se ejecuta en el threadpool para no bloquear el event loop
+    payload = await run_in_threadpool(_procesar_sync, file.file)
 
     final_name = (
         f"reporte_errores_{os.path.splitext(file.filename)[0]}_"
         f"{datetime.now().strftime('%Y%m%d_%H%M%S')}.txt"
     )
-    token = register_download(txt_bytes.getvalue(), final_name, "text/plain; charset=utf-8")
+    token = register_download(payload, final_name, "text/plain; charset=utf-8")
 
     return JSONResponse({"token": token, "filename": final_name})
 
 @app.get("/download/{token}")
-def download_token(token: str):
+async def download_token(token: str):
     cleanup_downloads()
     item = DOWNLOADS.get(token)
     if not item:
         raise HTTPException(status_code=404, detail="Link expirado o inválido")
+    DOWNLOADS.move_to_end(token)
 
     headers = {
         "Content-Disposition": f'attachment; filename="{item["filename"]}"',
         "Cache-Control": "no-store"
     }
-    return StreamingResponse(io.BytesIO(item["data"]), media_type=item["media_type"], headers=headers)
+    return Response(content=item["data"], media_type=item["media_type"], headers=headers)
+
+# Respuestas constantes serializadas una sola vez al importar
+_ROOT_BODY = json.dumps(
+    {"message": "API de validación de matrices funcionando 🚀"},
+    ensure_ascii=False,
+    separators=(",", ":"),
+).encode("utf-8")
+_HEALTH_BODY = b'{"status":"healthy"}'
 
 @app.get("/")
 async def root():
-    return {"message": "API de validación de matrices funcionando 🚀"}
+    return Response(content=_ROOT_BODY, media_type="application/json")
 
 @app.get("/health")
 async def health_check():
-    return {"status": "healthy"}
+    return Response(content=_HEALTH_BODY, media_type="application/json")
 
 